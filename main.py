@@ -1,10 +1,16 @@
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, simpledialog
 import numpy as np
 from PIL import Image, ImageTk, ImageDraw
 import os
 from pathlib import Path
 
+from mask_codec import CompactMask
+from mask_server import MaskClient, DEFAULT_HOST, DEFAULT_PORT, tile_bounds
+
+# Undo/Redo 記錄變動的 tile 大小
+HISTORY_TILE_SIZE = 256
+
 class SemanticSegmentationTool:
     def __init__(self, root):
         self.root = root
@@ -32,9 +38,11 @@ class SemanticSegmentationTool:
         # 橡皮擦模式（可保留或移除，若保留則與 draw_mode 綁定）
         self.erase_mode = tk.BooleanVar(value=False)
         
-        # Undo/Redo 堆疊
+        # Undo/Redo 堆疊，每筆為 [(tile 座標, 新增像素, 清除像素)]，以 CompactMask 壓縮儲存
         self.undo_stack = []
         self.redo_stack = []
+        # 編輯中各 tile 的原始內容（未在編輯時為 None）
+        self.edit_before = None
         
         # 畫布和遮罩
         self.display_image = None
@@ -42,6 +50,11 @@ class SemanticSegmentationTool:
         self.mask_image = None
 
         self.last_draw_pos = None  # 紀錄筆刷上一次的位置
+
+        # 多人遮罩伺服器連線（未連線時為 None）
+        self.mask_client = None
+        # 尚未送至伺服器的變動範圍，(ys, xs) 切片列表
+        self.dirty_regions = []
         
         self.setup_ui()
         self.setup_key_bindings()
@@ -195,6 +208,8 @@ class SemanticSegmentationTool:
                   command=self.load_mask).pack(fill=tk.X, pady=2)
         ttk.Button(action_frame, text="👁️ 顯示/隱藏",
                   command=self.toggle_mask).pack(fill=tk.X, pady=2)
+        ttk.Button(action_frame, text="🌐 連線/中斷遮罩伺服器",
+                  command=self.toggle_mask_server).pack(fill=tk.X, pady=2)
 
         # 縮放控制
         zoom_frame = ttk.LabelFrame(tools_frame, text="🔍 縮放控制", padding=10)
@@ -345,6 +360,11 @@ class SemanticSegmentationTool:
         # 清空 Undo/Redo 堆疊
         self.undo_stack = []
         self.redo_stack = []
+        self.edit_before = None
+        self.dirty_regions = []
+
+        # 已連線時，從伺服器取得此圖片的遮罩
+        self.open_mask_server_image()
 
         self.draw_image()
     
@@ -411,10 +431,9 @@ class SemanticSegmentationTool:
         if self.draw_mode.get() == "fill":
             self.fill_mask(event)
             return
-        # 儲存當前狀態以供 undo
+        # 記錄筆畫經過的 tile 以供 undo
         if self.mask_array is not None:
-            self.undo_stack.append(self.mask_array.copy())
-            self.redo_stack.clear() # 開始新繪製時，清除 redo 堆疊
+            self.begin_edit()
         self.is_drawing = True
         self.last_draw_pos = self.get_canvas_coords(event)
         self.draw_at_position(event)
@@ -428,6 +447,8 @@ class SemanticSegmentationTool:
         """停止繪製"""
         self.is_drawing = False
         self.last_draw_pos = None
+        if self.edit_before is not None:
+            self.end_edit()
     
     def draw_at_position(self, event):
         """在指定位置繪製"""
@@ -441,27 +462,39 @@ class SemanticSegmentationTool:
         if not (0 <= x < self.original_width and 0 <= y < self.original_height):
             return
 
-        mask_img = Image.fromarray(self.mask_array)
-        draw = ImageDraw.Draw(mask_img)
         # 根據模式決定填充值
         fill_value = 0 if self.draw_mode.get() == "eraser" else 255
         r = self.brush_size
+        points = [self.last_draw_pos, (x, y)] if self.last_draw_pos else [(x, y)]
+
+        # 只在筆刷涵蓋的範圍內繪製，不需複製整張遮罩
+        x0 = max(min(px for px, _ in points) - r - 1, 0)
+        y0 = max(min(py for _, py in points) - r - 1, 0)
+        x1 = min(max(px for px, _ in points) + r + 2, self.original_width)
+        y1 = min(max(py for _, py in points) + r + 2, self.original_height)
+        region = (slice(y0, y1), slice(x0, x1))
+        points = [(px - x0, py - y0) for px, py in points]
+
+        self.mark_dirty(region)
+        mask_img = Image.fromarray(np.ascontiguousarray(self.mask_array[region]))
+        draw = ImageDraw.Draw(mask_img)
+        cx, cy = points[-1]
 
-        if self.last_draw_pos:
+        if len(points) == 2:
             # 畫線段（筆刷軌跡）
-            draw.line([self.last_draw_pos, (x, y)], fill=fill_value, width=r * 2)
+            draw.line(points, fill=fill_value, width=r * 2)
 
             # 補起點圓形
-            lx, ly = self.last_draw_pos
+            lx, ly = points[0]
             draw.ellipse([lx - r, ly - r, lx + r, ly + r], fill=fill_value)
 
             # 補終點圓形
-            draw.ellipse([x - r, y - r, x + r, y + r], fill=fill_value)
+            draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=fill_value)
         else:
             # 只點一下的情況
-            draw.ellipse([x - r, y - r, x + r, y + r], fill=fill_value)
+            draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=fill_value)
 
-        self.mask_array = np.array(mask_img)
+        self.mask_array[region] = np.array(mask_img)
         self.last_draw_pos = (x, y)
         self.draw_image()
 
@@ -475,13 +508,13 @@ class SemanticSegmentationTool:
         if not (0 <= x < self.original_width and 0 <= y < self.original_height):
             return
 
-        self.undo_stack.append(self.mask_array.copy())
-        self.redo_stack.clear()
+        self.begin_edit()
 
         # 填充值
         fill_value = 255
         # 以原圖顏色作為起始點
         self.flood_fill(x, y, None, fill_value)
+        self.end_edit()
         self.draw_image()
 
     def flood_fill(self, x, y, target_value, fill_value):
@@ -521,46 +554,81 @@ class SemanticSegmentationTool:
                         ])
             to_fill = new_fill
 
+        # 記錄填色範圍
+        rows = np.flatnonzero(filled.any(axis=1))
+        cols = np.flatnonzero(filled.any(axis=0))
+        if rows.size:
+            self.mark_dirty((slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)))
+
         self.mask_array[filled] = fill_value
 
     def undo(self):
         """回復上一步"""
-        if not self.undo_stack:
+        if not self.undo_stack or self.mask_array is None:
             return
         
-        # 將當前狀態推入 redo 堆疊
-        if self.mask_array is None:
-            return
-        self.redo_stack.append(self.mask_array.copy())
-        
-        # 從 undo 堆疊中恢復上一個狀態
-        self.mask_array = self.undo_stack.pop()
+        # 只反轉這一步自己改過的像素，不影響其他標記者之後的編輯
+        entry = self.undo_stack.pop()
+        self.apply_history(entry, reverse=True)
+        self.redo_stack.append(entry)
         
+        self.sync_mask_server()
         self.draw_image()
 
     def redo(self):
         """重做下一步"""
-        if not self.redo_stack:
+        if not self.redo_stack or self.mask_array is None:
             return
             
-        # 將當前狀態推入 undo 堆疊
-        if self.mask_array is None:
-            return
-        self.undo_stack.append(self.mask_array.copy())
-        
-        # 從 redo 堆疊中恢復下一個狀態
-        self.mask_array = self.redo_stack.pop()
+        entry = self.redo_stack.pop()
+        self.apply_history(entry, reverse=False)
+        self.undo_stack.append(entry)
         
+        self.sync_mask_server()
         self.draw_image()
 
+    def begin_edit(self):
+        """開始一次可 undo 的編輯"""
+        self.edit_before = {}
+
+    def end_edit(self):
+        """結束編輯，將各 tile 的變動記錄為 undo 步驟並送至伺服器"""
+        entry = []
+        for key, before in self.edit_before.items():
+            region = tile_bounds(self.mask_array.shape, HISTORY_TILE_SIZE, *key)
+            current = self.mask_array[region] > 0
+            before = before.to_array() > 0
+            if np.array_equal(current, before):
+                continue
+            entry.append((key, CompactMask.from_array(current & ~before),
+                          CompactMask.from_array(before & ~current)))
+        self.edit_before = None
+
+        if entry:
+            self.undo_stack.append(entry)
+            self.redo_stack.clear() # 新的編輯會清除 redo 堆疊
+        self.sync_mask_server()
+
+    def apply_history(self, entry, reverse):
+        """套用（或反轉）一筆 undo 記錄"""
+        for key, set_mask, clear_mask in entry:
+            region = tile_bounds(self.mask_array.shape, HISTORY_TILE_SIZE, *key)
+            if reverse:
+                set_mask, clear_mask = clear_mask, set_mask
+            self.mark_dirty(region)
+            tile = self.mask_array[region]
+            tile[set_mask.to_array() > 0] = 255
+            tile[clear_mask.to_array() > 0] = 0
+
     def clear_mask(self):
         """清除遮罩"""
         if self.mask_array is not None:
-            # 儲存清除前的狀態以供 undo
-            self.undo_stack.append(self.mask_array.copy())
-            self.redo_stack.clear()
+            # 記錄清除前的狀態以供 undo
+            self.begin_edit()
+            self.mark_dirty()
             
             self.mask_array.fill(0)
+            self.end_edit()
             self.draw_image()
     
     def save_mask(self):
@@ -577,13 +645,20 @@ class SemanticSegmentationTool:
             title="儲存遮罩",
             defaultextension=".png",
             initialfile=default_name,
-            filetypes=[('PNG files', '*.png'), ('All files', '*.*')]
+            filetypes=[('PNG files', '*.png'),
+                      ('COCO RLE files', '*.json'),
+                      ('Compressed mask files', '*.npz'),
+                      ('All files', '*.*')]
         )
         
         if filename:
             try:
-                mask_img = Image.fromarray(self.mask_array)
-                mask_img.save(filename)
+                # .json / .npz 以壓縮格式儲存，其餘存為圖片
+                if os.path.splitext(filename)[1].lower() in ('.json', '.npz'):
+                    CompactMask.from_array(self.mask_array).save(filename)
+                else:
+                    mask_img = Image.fromarray(self.mask_array)
+                    mask_img.save(filename)
                 messagebox.showinfo("成功", f"遮罩已儲存至: {filename}")
             except Exception as e:
                 messagebox.showerror("錯誤", f"儲存失敗: {str(e)}")
@@ -597,23 +672,35 @@ class SemanticSegmentationTool:
         filename = filedialog.askopenfilename(
             title="載入遮罩",
             filetypes=[('Image files', '*.png *.jpg *.jpeg *.bmp *.tiff'), 
+                      ('Compressed mask files', '*.json *.npz'),
                       ('All files', '*.*')]
         )
         
+        if filename and self.mask_client is not None:
+            if not messagebox.askyesno(
+                    "確認", "已連線遮罩伺服器，載入的遮罩會取代所有標記者共用的遮罩。確定要載入嗎？"):
+                return
+
         if filename:
             try:
-                # 儲存載入前的狀態以供 undo
-                if self.mask_array is not None:
-                    self.undo_stack.append(self.mask_array.copy())
-                    self.redo_stack.clear()
-
-                mask_img = Image.open(filename).convert('L')
+                if os.path.splitext(filename)[1].lower() in ('.json', '.npz'):
+                    mask_img = Image.fromarray(CompactMask.load(filename).to_array())
+                else:
+                    mask_img = Image.open(filename).convert('L')
                 
                 # 調整遮罩大小以匹配原始圖片
                 mask_img = mask_img.resize((self.original_width, self.original_height), 
                                          Image.Resampling.NEAREST)
                 
-                self.mask_array = np.array(mask_img)
+                # 記錄載入前的狀態以供 undo；只有內容不同的 tile 會記錄及送出
+                self.begin_edit()
+                self.mark_dirty()
+
+                # 與顯示一致，大於 0 即為前景（0/1 標籤圖也能載入）；
+                # 只有 JPEG 以中間值二值化，避免壓縮雜訊被當成前景
+                threshold = 128 if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg') else 1
+                self.mask_array[:] = np.where(np.array(mask_img) >= threshold, 255, 0)
+                self.end_edit()
                 self.draw_image()
                 
                 messagebox.showinfo("成功", "遮罩載入成功！")
@@ -624,6 +711,110 @@ class SemanticSegmentationTool:
         """切換遮罩顯示"""
         self.mask_visible = not self.mask_visible
         self.draw_image()
+
+    def toggle_mask_server(self):
+        """連線或中斷多人遮罩伺服器"""
+        if self.mask_client is not None:
+            self.mask_client.close()
+            self.mask_client = None
+            messagebox.showinfo("成功", "已中斷遮罩伺服器連線")
+            return
+
+        address = simpledialog.askstring(
+            "連線遮罩伺服器", "伺服器位址（host:port 或 unix:路徑）:",
+            initialvalue=f"{DEFAULT_HOST}:{DEFAULT_PORT}")
+        if not address:
+            return
+
+        # 本機已有遮罩時，由使用者決定是否合併；合併是聯集，可能還原其他人已擦除的像素
+        keep_local = True
+        if self.mask_array is not None and self.mask_array.any():
+            keep_local = messagebox.askyesnocancel(
+                "合併遮罩",
+                "本機遮罩已有內容。\n\n"
+                "是：將本機前景加入共用遮罩（其他人已擦除的像素可能被還原）\n"
+                "否：捨棄本機遮罩，改用伺服器上的共用遮罩")
+            if keep_local is None:
+                return
+
+        try:
+            if address.startswith("unix:"):
+                self.mask_client = MaskClient(unix_path=address[len("unix:"):])
+            else:
+                host, _, port = address.rpartition(":")
+                self.mask_client = MaskClient(host or DEFAULT_HOST, int(port))
+        except (OSError, ValueError) as e:
+            messagebox.showerror("錯誤", f"無法連線: {str(e)}")
+            return
+
+        if not keep_local:
+            # 本機遮罩將被清除，原本的 undo 記錄已不適用
+            self.undo_stack = []
+            self.redo_stack = []
+        self.open_mask_server_image(keep_local)
+        self.draw_image()
+        self.poll_mask_server(self.mask_client)
+
+    def poll_mask_server(self, client):
+        """定期套用伺服器推送的 tile 更新"""
+        # 已中斷或重新連線時，舊的輪詢直接結束
+        if client is not self.mask_client:
+            return
+
+        # 筆畫進行中先不套用，避免別人的編輯被記入自己的 undo 步驟
+        if (self.mask_array is not None and self.edit_before is None
+                and client.poll(self.mask_array)):
+            self.draw_image()
+
+        if client.open_failed:
+            client.close()
+            self.mask_client = None
+            messagebox.showwarning("警告", f"伺服器拒絕開啟此圖片，已中斷連線: {client.error}")
+            return
+        if client.error:
+            messagebox.showwarning("警告", f"遮罩伺服器: {client.error}")
+            client.error = None
+        if not client.connected:
+            client.close()
+            self.mask_client = None
+            messagebox.showwarning("警告", "與遮罩伺服器的連線已中斷")
+            return
+
+        self.root.after(100, self.poll_mask_server, client)
+
+    def open_mask_server_image(self, keep_local=True):
+        """在伺服器上開啟目前圖片的遮罩"""
+        if self.mask_client is None or self.mask_array is None:
+            return
+        image = os.path.basename(self.images[self.current_image_index])
+        self.mask_client.open_image(image, self.mask_array, keep_local)
+
+    def mark_dirty(self, region=None):
+        """在修改遮罩前記錄變動範圍；region 為 None 時表示整張遮罩"""
+        if region is None:
+            region = (slice(0, self.original_height), slice(0, self.original_width))
+        self.dirty_regions.append(region)
+
+        # 編輯中時，保存範圍內尚未記錄的 tile 原始內容
+        if self.edit_before is None:
+            return
+        ys, xs = region
+        y0, y1, _ = ys.indices(self.original_height)
+        x0, x1, _ = xs.indices(self.original_width)
+        if y1 <= y0 or x1 <= x0:
+            return
+        for ty in range(y0 // HISTORY_TILE_SIZE, (y1 - 1) // HISTORY_TILE_SIZE + 1):
+            for tx in range(x0 // HISTORY_TILE_SIZE, (x1 - 1) // HISTORY_TILE_SIZE + 1):
+                if (ty, tx) not in self.edit_before:
+                    tile = self.mask_array[tile_bounds(self.mask_array.shape, HISTORY_TILE_SIZE, ty, tx)]
+                    self.edit_before[(ty, tx)] = CompactMask.from_array(tile)
+
+    def sync_mask_server(self):
+        """將本機編輯過的 tile 送至伺服器"""
+        regions, self.dirty_regions = self.dirty_regions, []
+        if self.mask_client is None or self.mask_array is None:
+            return
+        self.mask_client.sync(self.mask_array, regions)
     
     def zoom(self, factor):
         """縮放"""
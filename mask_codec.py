@@ -0,0 +1,165 @@
+import json
+import os
+
+import numpy as np
+
+
+def encode_rle(mask, order='F'):
+    """將二值遮罩編碼為 RLE counts（從 0 開始計數）
+
+    order='F' 為 COCO 格式的行優先；order='C' 為列優先，不需轉置，供記憶體內使用。
+    """
+    mask = np.asarray(mask)
+    if order == 'F':
+        mask = mask.T
+    n = mask.size
+    dtype = np.uint32 if n < 2 ** 32 else np.uint64
+    if n == 0:
+        return np.array([0], dtype=dtype)
+
+    # 只掃描第一個到最後一個非空白列之間的範圍，大片空白不需逐像素比較
+    rows = np.flatnonzero(mask.reshape(mask.shape[0], -1).any(axis=1))
+    if rows.size == 0:
+        return np.array([n], dtype=dtype)
+    row_size = n // mask.shape[0]
+    offset = rows[0] * row_size
+    span = mask[rows[0]:rows[-1] + 1].ravel() > 0
+
+    # 前後補 0 後找出值改變的位置，相鄰邊界的差即為每段長度
+    padded = np.concatenate(([False], span, [False]))
+    change = np.flatnonzero(padded[1:] != padded[:-1]) + offset
+    bounds = np.concatenate(([0], change, [n]))
+    counts = np.diff(bounds)
+
+    # 遮罩結尾為前景時，最後會多出一段長度 0 的背景
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    return counts.astype(dtype)
+
+
+def decode_rle(counts, shape, order='F'):
+    """將 RLE counts 解碼為 uint8 遮罩（0/255），order 與 encode_rle 相同"""
+    counts = np.asarray(counts, dtype=np.int64)
+    h, w = shape
+    if counts.sum() != h * w:
+        raise ValueError(f"RLE 長度 {counts.sum()} 與尺寸 {h}×{w} 不符")
+
+    # 奇數段為前景，偶數段為背景；只展開第一段到最後一段前景之間的範圍
+    flat = np.zeros(h * w, dtype=np.uint8)
+    if counts.size > 1:
+        last = counts.size - 1 if counts.size % 2 == 0 else counts.size - 2
+        start, end = counts[0], counts[:last + 1].sum()
+        values = (np.arange(1, last + 1) % 2).astype(np.uint8) * 255
+        flat[start:end] = np.repeat(values, counts[1:last + 1])
+    return np.ascontiguousarray(flat.reshape((h, w), order=order))
+
+
+def validate_rle(rle):
+    """檢查 COCO 未壓縮 RLE 格式，回傳 (counts, (h, w))；格式錯誤時拋出 ValueError"""
+    try:
+        counts, size = rle["counts"], rle["size"]
+    except (KeyError, TypeError):
+        raise ValueError("RLE 缺少 counts 或 size") from None
+
+    size = np.asarray(size)
+    if size.shape != (2,) or size.dtype.kind != 'i' or (size < 0).any():
+        raise ValueError("RLE size 必須為兩個非負整數")
+    h, w = int(size[0]), int(size[1])
+
+    # 超出 int64 的整數會變成 uint64 或 object，一併視為格式錯誤
+    counts = np.asarray(counts)
+    if counts.ndim != 1 or counts.size == 0 or counts.dtype.kind != 'i':
+        raise ValueError("RLE counts 必須為整數列表")
+    if (counts < 0).any() or (counts > h * w).any():
+        raise ValueError("RLE counts 超出範圍")
+    if counts.sum() != h * w:
+        raise ValueError(f"RLE 長度 {counts.sum()} 與尺寸 {h}×{w} 不符")
+    return counts.astype(np.int64), (h, w)
+
+
+def pack_bits(mask):
+    """將二值遮罩以每像素 1 bit 打包"""
+    return np.packbits(np.asarray(mask).ravel() > 0)
+
+
+def unpack_bits(packed, shape):
+    """將打包的 bits 還原為 uint8 遮罩（0/255）"""
+    h, w = shape
+    bits = np.unpackbits(packed, count=h * w)
+    return (bits * 255).reshape((h, w))
+
+
+class CompactMask:
+    """壓縮的二值遮罩，依內容自動選擇 RLE 或 bit-packing 中較小者
+
+    內部的 RLE 為列優先，與 uint8 遮罩的記憶體順序相同，編碼不需轉置；
+    只有匯出 COCO RLE（to_rle / .json）時才轉為行優先。
+    """
+
+    def __init__(self, shape, encoding, data):
+        if encoding not in ("rle", "bits"):
+            raise ValueError(f"不支援的編碼: {encoding}")
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.encoding = encoding
+        self.data = data
+
+    @classmethod
+    def from_array(cls, mask_array, encoding=None):
+        """由密集遮罩建立；encoding 為 None 時自動選擇較小的編碼"""
+        mask_array = np.asarray(mask_array)
+        shape = mask_array.shape
+        if encoding == "bits":
+            return cls(shape, "bits", pack_bits(mask_array))
+
+        counts = encode_rle(mask_array, order='C')
+        if encoding is None and counts.nbytes > (mask_array.size + 7) // 8:
+            return cls(shape, "bits", pack_bits(mask_array))
+        return cls(shape, "rle", counts)
+
+    @classmethod
+    def from_rle(cls, rle):
+        """由 COCO 未壓縮 RLE（{"size": [h, w], "counts": [...]}）建立"""
+        counts, shape = validate_rle(rle)
+        return cls.from_array(decode_rle(counts, shape))
+
+    def to_array(self):
+        """還原為 uint8 密集遮罩（0/255）"""
+        if self.encoding == "rle":
+            return decode_rle(self.data, self.shape, order='C')
+        return unpack_bits(self.data, self.shape)
+
+    def to_rle(self):
+        """匯出為 COCO 未壓縮 RLE，可直接作為 annotation 的 segmentation"""
+        counts = encode_rle(self.to_array())
+        return {"size": list(self.shape), "counts": counts.tolist()}
+
+    @property
+    def nbytes(self):
+        """壓縮後資料大小（bytes）"""
+        return self.data.nbytes
+
+    def save(self, filename):
+        """依副檔名儲存：.json 為 COCO RLE，.npz 為壓縮的 NumPy 檔"""
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == ".json":
+            with open(filename, "w", encoding="utf-8") as f:
+                json.dump(self.to_rle(), f)
+        elif ext == ".npz":
+            np.savez_compressed(filename, shape=np.array(self.shape),
+                                encoding=np.array(self.encoding), data=self.data)
+        else:
+            raise ValueError(f"不支援的遮罩格式: {ext}")
+
+    @classmethod
+    def load(cls, filename):
+        """依副檔名載入 .json（COCO RLE）或 .npz 遮罩"""
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == ".json":
+            with open(filename, "r", encoding="utf-8") as f:
+                rle = json.load(f)
+            # 同時接受單獨的 RLE 或含 segmentation 欄位的 COCO annotation
+            return cls.from_rle(rle.get("segmentation", rle))
+        if ext == ".npz":
+            with np.load(filename) as npz:
+                return cls(tuple(npz["shape"]), str(npz["encoding"]), npz["data"])
+        raise ValueError(f"不支援的遮罩格式: {ext}")
@@ -0,0 +1,443 @@
+"""本機多人遮罩伺服器
+
+以版本化的 tile 保存遮罩，接收多個 GUI 客戶端的 tile 差異（新增/清除像素），
+並將變動後的 tile 推送給所有開啟同一張圖片的客戶端。
+
+協定為每行一個 JSON 訊息，tile 內容以 COCO RLE 傳輸：
+    客戶端 → 伺服器
+        {"op": "open", "image": 名稱, "shape": [h, w]}
+        {"op": "edit", "image": 名稱, "seq": 編號, "tiles": [{"ty", "tx", "set": RLE, "clear": RLE}]}
+    伺服器 → 客戶端
+        {"op": "snapshot", "image", "tile_size", "tiles": [{"ty", "tx", "version", "mask": RLE}]}
+        {"op": "tiles", "image", "tiles": [{"ty", "tx", "version", "mask": RLE}]}
+        {"op": "ack", "image", "seq"}                 （僅回覆送出編輯的客戶端）
+        {"op": "error", "message": 訊息, "request": 原操作, "image", "seq": 編號}
+                                                     （被拒絕的編輯不會套用任何 tile）
+
+差異以「新增/清除」表示，因此多人同時編輯同一 tile 的不同像素時可直接合併。
+
+啟動方式：
+    python mask_server.py --port 8765
+    python mask_server.py --unix /tmp/maskforge.sock
+"""
+import argparse
+import asyncio
+import json
+import queue
+import socket
+import threading
+
+import numpy as np
+
+from mask_codec import CompactMask, decode_rle, encode_rle, validate_rle
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_TILE_SIZE = 512
+# 單一訊息上限（snapshot 可能包含大量 tile）
+MESSAGE_LIMIT = 2 ** 28
+# 客戶端單次 edit 訊息的大小上限，超過時分批送出
+EDIT_BATCH_LIMIT = MESSAGE_LIMIT // 4
+
+
+def tile_bounds(shape, tile_size, ty, tx):
+    """回傳 tile 在整張遮罩中的切片"""
+    h, w = shape
+    y0, x0 = ty * tile_size, tx * tile_size
+    return slice(y0, min(y0 + tile_size, h)), slice(x0, min(x0 + tile_size, w))
+
+
+def encode_tile(mask):
+    """將 tile 編碼為 COCO RLE"""
+    return {"size": list(mask.shape), "counts": encode_rle(mask).tolist()}
+
+
+def decode_tile(rle, shape=None):
+    """將 COCO RLE 解碼為 bool tile；指定 shape 時先檢查尺寸再解碼"""
+    counts, size = validate_rle(rle)
+    if shape is not None and size != tuple(shape):
+        raise ValueError(f"tile 尺寸 {size[0]}×{size[1]} 與預期 {shape[0]}×{shape[1]} 不符")
+    return decode_rle(counts, size) > 0
+
+
+class MaskDocument:
+    """單張圖片的遮罩，以版本化 tile 儲存（空白 tile 不佔空間）"""
+
+    def __init__(self, shape, tile_size):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.tile_size = tile_size
+        self.tiles = {}     # (ty, tx) -> CompactMask
+        self.versions = {}  # (ty, tx) -> int
+
+    def get_tile(self, ty, tx):
+        """取得 tile 內容（bool 陣列）"""
+        if (ty, tx) in self.tiles:
+            return self.tiles[(ty, tx)].to_array() > 0
+        ys, xs = tile_bounds(self.shape, self.tile_size, ty, tx)
+        return np.zeros((ys.stop - ys.start, xs.stop - xs.start), dtype=bool)
+
+    def tile_shape(self, ty, tx):
+        """回傳 tile 尺寸；座標超出範圍時拋出 ValueError"""
+        ny = -(-self.shape[0] // self.tile_size)
+        nx = -(-self.shape[1] // self.tile_size)
+        if not (0 <= ty < ny and 0 <= tx < nx):
+            raise ValueError(f"tile ({ty}, {tx}) 超出範圍")
+
+        ys, xs = tile_bounds(self.shape, self.tile_size, ty, tx)
+        return ys.stop - ys.start, xs.stop - xs.start
+
+    def apply_delta(self, ty, tx, set_mask, clear_mask):
+        """套用差異並遞增版本，回傳新的 tile 內容"""
+        tile = (self.get_tile(ty, tx) | set_mask) & ~clear_mask
+
+        if tile.any():
+            self.tiles[(ty, tx)] = CompactMask.from_array(tile)
+        else:
+            self.tiles.pop((ty, tx), None)
+        self.versions[(ty, tx)] = self.versions.get((ty, tx), 0) + 1
+        return tile
+
+    def tile_message(self, ty, tx, tile=None):
+        """產生單一 tile 的傳輸格式"""
+        if tile is None:
+            tile = self.get_tile(ty, tx)
+        return {"ty": ty, "tx": tx, "version": self.versions.get((ty, tx), 0),
+                "mask": encode_tile(tile)}
+
+    def snapshot(self):
+        """所有非空白 tile 的傳輸格式"""
+        return [self.tile_message(ty, tx) for ty, tx in self.tiles]
+
+
+class MaskServer:
+    """asyncio 遮罩伺服器；所有編輯在事件迴圈中依序處理，不需額外上鎖"""
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE):
+        self.tile_size = tile_size
+        self.documents = {}    # 圖片名稱 -> MaskDocument
+        self.subscribers = {}  # 圖片名稱 -> set(StreamWriter)
+
+    async def handle_client(self, reader, writer):
+        """處理單一客戶端連線"""
+        image = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = {}
+                try:
+                    msg = json.loads(line)
+                    if not isinstance(msg, dict):
+                        raise ValueError("訊息必須為 JSON 物件")
+                    op = msg.get("op")
+                    if op == "open":
+                        self.unsubscribe(image, writer)
+                        image = None
+                        await self.open_image(msg["image"], msg["shape"], writer)
+                        image = msg["image"]
+                    elif op == "edit":
+                        if msg.get("image") != image:
+                            raise ValueError("尚未開啟此圖片")
+                        await self.apply_edit(image, msg["tiles"])
+                        await self.send(writer, {"op": "ack", "image": image,
+                                                 "seq": msg.get("seq")})
+                    else:
+                        raise ValueError(f"未知的操作: {op}")
+                except (ValueError, KeyError, TypeError, OverflowError) as e:
+                    if not isinstance(msg, dict):
+                        msg = {}
+                    await self.send(writer, {"op": "error", "message": str(e),
+                                             "request": msg.get("op"), "image": msg.get("image"),
+                                             "seq": msg.get("seq")})
+        except ConnectionError:
+            pass
+        except ValueError:
+            # 單一訊息超過 MESSAGE_LIMIT，無法再正確分行，回覆錯誤後關閉連線
+            await self.send(writer, {"op": "error", "message": "訊息超過大小上限，連線已關閉",
+                                     "request": None, "image": None, "seq": None})
+        finally:
+            self.unsubscribe(image, writer)
+            writer.close()
+
+    async def open_image(self, image, shape, writer):
+        """開啟（或建立）圖片遮罩並回傳 snapshot"""
+        shape = (int(shape[0]), int(shape[1]))
+        doc = self.documents.get(image)
+        if doc is None:
+            doc = self.documents[image] = MaskDocument(shape, self.tile_size)
+        elif doc.shape != shape:
+            raise ValueError(f"圖片尺寸不符: 伺服器為 {doc.shape[0]}×{doc.shape[1]}")
+
+        self.subscribers.setdefault(image, set()).add(writer)
+        await self.send(writer, {"op": "snapshot", "image": image,
+                                 "tile_size": doc.tile_size, "tiles": doc.snapshot()})
+
+    async def apply_edit(self, image, tiles):
+        """套用客戶端送來的 tile 差異並廣播更新後的 tile"""
+        doc = self.documents[image]
+        # 先全部檢查，避免只套用部分差異
+        deltas = []
+        for t in tiles:
+            ty, tx = int(t["ty"]), int(t["tx"])
+            shape = doc.tile_shape(ty, tx)
+            deltas.append((ty, tx, decode_tile(t["set"], shape), decode_tile(t["clear"], shape)))
+
+        updated = []
+        for ty, tx, set_mask, clear_mask in deltas:
+            tile = doc.apply_delta(ty, tx, set_mask, clear_mask)
+            updated.append(doc.tile_message(ty, tx, tile))
+
+        msg = {"op": "tiles", "image": image, "tiles": updated}
+        for subscriber in list(self.subscribers.get(image, ())):
+            await self.send(subscriber, msg)
+
+    def unsubscribe(self, image, writer):
+        """取消訂閱圖片更新"""
+        if image in self.subscribers:
+            self.subscribers[image].discard(writer)
+
+    async def send(self, writer, msg):
+        """傳送單一訊息；連線中斷時忽略"""
+        try:
+            writer.write((json.dumps(msg) + "\n").encode("utf-8"))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class MaskClient:
+    """給 tkinter GUI 使用的同步客戶端
+
+    背景執行緒接收伺服器訊息，GUI 在主執行緒定期呼叫 poll() 套用更新，
+    並在每次編輯後以變動範圍呼叫 sync()，只比對及送出這些範圍內的 tile。
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+        if unix_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.send_lock = threading.Lock()
+        self.messages = queue.Queue()
+        self.connected = True
+        self.error = None
+        self.open_failed = False  # 伺服器拒絕開啟目前圖片
+
+        self.image = None
+        self.shape = None
+        self.tile_size = None  # 收到 snapshot 前為 None
+        self.baseline = {}     # (ty, tx) -> CompactMask，伺服器上已知的非空白 tile
+        self.versions = {}
+        self.pending = []      # 收到 snapshot 前的變動範圍
+        self.seq = 0
+        self.sent = {}         # seq -> {(ty, tx): (送出前的 baseline, 送出時的版本)}
+
+        self.reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader_thread.start()
+
+    def _read_loop(self):
+        """背景接收訊息"""
+        try:
+            with self.sock.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    self.messages.put(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        self.messages.put({"op": "closed"})
+
+    def _send(self, msg):
+        """傳送單一訊息；連線中斷時標記為未連線，由 GUI 透過 connected 得知"""
+        try:
+            with self.send_lock:
+                self.sock.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+        except OSError:
+            self.connected = False
+
+    def close(self):
+        """關閉連線"""
+        self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def open_image(self, image, mask_array, keep_local=True):
+        """開啟伺服器上的圖片遮罩
+
+        keep_local 為 True 時，本機已有的前景會在收到 snapshot 後以聯集合併送出，
+        因此可能還原其他人在斷線期間擦除的像素；為 False 時先清空本機遮罩，
+        完全以伺服器內容為準。
+        """
+        if not keep_local:
+            mask_array[:] = 0
+        self.image = image
+        self.shape = mask_array.shape
+        self.tile_size = None
+        self.baseline = {}
+        self.versions = {}
+        self.sent = {}
+        self.open_failed = False
+        h, w = self.shape
+        self.pending = [(slice(0, h), slice(0, w))] if mask_array.any() else []
+        self._send({"op": "open", "image": image, "shape": list(self.shape)})
+
+    def sync(self, mask_array, regions):
+        """比對 regions（(ys, xs) 切片列表）涵蓋的 tile，將與伺服器不同者以差異送出"""
+        if not self.connected or self.open_failed:
+            return
+        if self.tile_size is None:
+            self.pending.extend(regions)
+            return
+
+        batch, previous, size = [], {}, 0
+        for key in self._region_tiles(regions):
+            region = tile_bounds(self.shape, self.tile_size, *key)
+            cur, base = mask_array[region] > 0, self._base(key)
+            if np.array_equal(cur, base):
+                continue
+            tile = {"ty": key[0], "tx": key[1],
+                    "set": encode_tile(cur & ~base),
+                    "clear": encode_tile(base & ~cur)}
+            tile_bytes = len(json.dumps(tile))
+            if batch and size + tile_bytes > EDIT_BATCH_LIMIT:
+                self._send_edit(batch, previous)
+                batch, previous, size = [], {}, 0
+            batch.append(tile)
+            size += tile_bytes
+            # 先假設伺服器會接受；被拒絕時再以 previous 還原
+            previous[key] = (base, self.versions.get(key, 0))
+            self._set_base(key, cur)
+
+        if batch:
+            self._send_edit(batch, previous)
+
+    def _send_edit(self, tiles, previous):
+        """以新的 seq 送出一批 tile 差異"""
+        self.seq += 1
+        self.sent[self.seq] = previous
+        self._send({"op": "edit", "image": self.image, "seq": self.seq, "tiles": tiles})
+
+    def poll(self, mask_array):
+        """套用已收到的伺服器更新至 mask_array（原地修改），回傳是否有變動"""
+        changed = False
+        while True:
+            try:
+                msg = self.messages.get_nowait()
+            except queue.Empty:
+                break
+
+            op = msg.get("op")
+            if op == "closed":
+                self.connected = False
+            elif op == "error":
+                self.error = msg["message"]
+                if (msg.get("request") == "open" and msg.get("image") == self.image
+                        and self.tile_size is None):
+                    # 伺服器拒絕開啟：此圖片不會同步，不再累積變動範圍
+                    self.open_failed = True
+                    self.pending = []
+                else:
+                    changed = self._rollback(mask_array, msg.get("seq")) or changed
+            elif msg.get("image") != self.image:
+                continue
+            elif op == "ack":
+                self.sent.pop(msg["seq"], None)
+            elif op == "snapshot":
+                self.tile_size = msg["tile_size"]
+                changed = self._apply_tiles(mask_array, msg["tiles"]) or changed
+                # 送出開啟前就存在的本機編輯
+                pending, self.pending = self.pending, []
+                self.sync(mask_array, pending)
+            elif op == "tiles" and self.tile_size is not None:
+                changed = self._apply_tiles(mask_array, msg["tiles"]) or changed
+        return changed
+
+    def _region_tiles(self, regions):
+        """回傳 regions 涵蓋的 tile 座標"""
+        h, w = self.shape
+        keys = set()
+        for ys, xs in regions:
+            y0, y1, _ = ys.indices(h)
+            x0, x1, _ = xs.indices(w)
+            if y1 <= y0 or x1 <= x0:
+                continue
+            for ty in range(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1):
+                for tx in range(x0 // self.tile_size, (x1 - 1) // self.tile_size + 1):
+                    keys.add((ty, tx))
+        return sorted(keys)
+
+    def _base(self, key):
+        """取得 tile 的 baseline（bool 陣列）"""
+        if key in self.baseline:
+            return self.baseline[key].to_array() > 0
+        ys, xs = tile_bounds(self.shape, self.tile_size, *key)
+        return np.zeros((ys.stop - ys.start, xs.stop - xs.start), dtype=bool)
+
+    def _set_base(self, key, tile):
+        if tile.any():
+            self.baseline[key] = CompactMask.from_array(tile)
+        else:
+            self.baseline.pop(key, None)
+
+    def _rollback(self, mask_array, seq):
+        """伺服器拒絕編輯時，將尚未被更新的 tile 還原為伺服器狀態"""
+        changed = False
+        for key, (base, version) in self.sent.pop(seq, {}).items():
+            # 之後已收到此 tile 的廣播時，baseline 已是伺服器內容
+            if self.versions.get(key, 0) == version:
+                self._merge(mask_array, base, key)
+                changed = True
+        return changed
+
+    def _apply_tiles(self, mask_array, tiles):
+        changed = False
+        for t in tiles:
+            key = (t["ty"], t["tx"])
+            if t["version"] <= self.versions.get(key, 0):
+                continue
+            self.versions[key] = t["version"]
+            self._merge(mask_array, decode_tile(t["mask"]), key)
+            changed = True
+        return changed
+
+    def _merge(self, mask_array, server, key):
+        """以伺服器內容取代 baseline，並保留本機尚未送出的差異"""
+        region = tile_bounds(self.shape, self.tile_size, *key)
+        current = mask_array[region] > 0
+        base = self._base(key)
+        merged = (server | (current & ~base)) & ~(base & ~current)
+        mask_array[region] = np.where(merged, 255, 0)
+        self._set_base(key, server)
+
+
+async def serve(host, port, unix_path, tile_size):
+    """啟動伺服器並持續執行"""
+    server = MaskServer(tile_size)
+    if unix_path:
+        srv = await asyncio.start_unix_server(server.handle_client, unix_path,
+                                              limit=MESSAGE_LIMIT)
+        print(f"遮罩伺服器啟動於 unix:{unix_path}")
+    else:
+        srv = await asyncio.start_server(server.handle_client, host, port,
+                                         limit=MESSAGE_LIMIT)
+        print(f"遮罩伺服器啟動於 {host}:{port}")
+    async with srv:
+        await srv.serve_forever()
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="MaskForge 多人遮罩伺服器")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", help="改用 Unix socket 路徑")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.unix, args.tile_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 讓測試可以直接匯入專案根目錄的模組
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
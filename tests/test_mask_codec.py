@@ -0,0 +1,130 @@
+import json
+
+import numpy as np
+import pytest
+
+from mask_codec import CompactMask, decode_rle, encode_rle, validate_rle
+
+
+def random_mask(shape, density, seed=0):
+    rng = np.random.default_rng(seed)
+    return ((rng.random(shape) < density) * 255).astype(np.uint8)
+
+
+def edge_masks():
+    """空白、全滿、前景在開頭/結尾等邊界情況"""
+    empty = np.zeros((5, 7), dtype=np.uint8)
+    full = np.full((5, 7), 255, dtype=np.uint8)
+    start = empty.copy()
+    start[0, 0] = 255
+    end = empty.copy()
+    end[-1, -1] = 255
+    both = start | end
+    return [empty, full, start, end, both]
+
+
+def test_coco_counts_are_column_major():
+    mask = np.zeros((3, 4), dtype=np.uint8)
+    mask[0, 1] = 255
+    assert encode_rle(mask).tolist() == [3, 1, 8]
+    assert encode_rle(mask, order='C').tolist() == [1, 1, 10]
+
+
+def test_counts_start_with_background_run():
+    mask = np.full((2, 2), 255, dtype=np.uint8)
+    assert encode_rle(mask).tolist() == [0, 4]
+    assert encode_rle(np.zeros((2, 2), dtype=np.uint8)).tolist() == [4]
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+@pytest.mark.parametrize("index", range(5))
+def test_encode_decode_edge_cases(order, index):
+    mask = edge_masks()[index]
+    counts = encode_rle(mask, order=order)
+    assert counts.sum() == mask.size
+    assert (decode_rle(counts, mask.shape, order=order) == mask).all()
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+@pytest.mark.parametrize("density", [0.01, 0.5, 0.99])
+def test_encode_decode_random(order, density):
+    mask = random_mask((37, 53), density)
+    counts = encode_rle(mask, order=order)
+    assert (decode_rle(counts, mask.shape, order=order) == mask).all()
+
+
+@pytest.mark.parametrize("encoding", [None, "rle", "bits"])
+@pytest.mark.parametrize("index", range(5))
+def test_compact_mask_round_trip(encoding, index):
+    mask = edge_masks()[index]
+    compact = CompactMask.from_array(mask, encoding=encoding)
+    restored = compact.to_array()
+    assert (restored == mask).all()
+    assert restored.flags.c_contiguous
+    assert (CompactMask.from_rle(compact.to_rle()).to_array() == mask).all()
+
+
+def test_nonzero_values_are_foreground():
+    mask = np.array([[0, 1], [7, 255]], dtype=np.uint8)
+    assert (CompactMask.from_array(mask).to_array() == (mask > 0) * 255).all()
+
+
+def test_auto_encoding_picks_smaller():
+    sparse = np.zeros((100, 100), dtype=np.uint8)
+    sparse[10:20, 10:20] = 255
+    noisy = random_mask((100, 100), 0.5)
+
+    assert CompactMask.from_array(sparse).encoding == "rle"
+    assert CompactMask.from_array(noisy).encoding == "bits"
+    assert CompactMask.from_array(noisy).nbytes == (100 * 100 + 7) // 8
+
+
+@pytest.mark.parametrize("ext", [".json", ".npz"])
+@pytest.mark.parametrize("density", [0.0, 0.01, 0.5])
+def test_save_load(tmp_path, ext, density):
+    mask = random_mask((31, 17), density)
+    filename = str(tmp_path / f"mask{ext}")
+    CompactMask.from_array(mask).save(filename)
+    assert (CompactMask.load(filename).to_array() == mask).all()
+
+
+def test_load_coco_annotation(tmp_path):
+    mask = np.zeros((3, 4), dtype=np.uint8)
+    mask[0, 1] = 255
+    filename = tmp_path / "ann.json"
+    filename.write_text(json.dumps({
+        "id": 1, "image_id": 1, "category_id": 1, "iscrowd": 1,
+        "segmentation": {"size": [3, 4], "counts": [3, 1, 8]},
+    }), encoding="utf-8")
+    assert (CompactMask.load(str(filename)).to_array() == mask).all()
+
+
+def test_save_rejects_unknown_extension(tmp_path):
+    with pytest.raises(ValueError):
+        CompactMask.from_array(np.zeros((2, 2), dtype=np.uint8)).save(str(tmp_path / "m.png"))
+
+
+def test_validate_rle_accepts_valid():
+    counts, shape = validate_rle({"size": [3, 4], "counts": [3, 1, 8]})
+    assert counts.tolist() == [3, 1, 8]
+    assert shape == (3, 4)
+
+
+@pytest.mark.parametrize("rle", [
+    {"size": [3, 4], "counts": [-1, 13]},        # 負數
+    {"size": [3, 4], "counts": [3, 1, 7]},       # 總和不符
+    {"size": [3, 4], "counts": [13]},            # 超出範圍
+    {"size": [3.0, 4], "counts": [12]},          # size 非整數
+    {"size": [3], "counts": [3]},                # size 長度錯誤
+    {"size": [-3, 4], "counts": [0]},            # size 為負
+    {"size": [3, 4], "counts": [1.5, 10.5]},     # counts 非整數
+    {"size": [3, 4], "counts": []},              # counts 為空
+    {"size": [3, 4], "counts": [2 ** 70]},       # 超出 int64
+    {"size": [3, 4]},                            # 缺少 counts
+    [3, 1, 8],                                   # 非物件
+])
+def test_validate_rle_rejects_invalid(rle):
+    with pytest.raises(ValueError):
+        validate_rle(rle)
+    with pytest.raises(ValueError):
+        CompactMask.from_rle(rle)
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import mask_server
+from mask_server import MESSAGE_LIMIT, MaskClient, MaskServer
+
+TILE_SIZE = 64
+SHAPE = (200, 150)
+FULL = [(slice(None), slice(None))]
+
+
+@pytest.fixture
+def port(request):
+    """在背景執行緒啟動伺服器，回傳連接埠；可用 indirect 參數指定訊息上限"""
+    limit = getattr(request, "param", MESSAGE_LIMIT)
+    loop = asyncio.new_event_loop()
+    server = MaskServer(TILE_SIZE)
+    srv = loop.run_until_complete(asyncio.start_server(
+        server.handle_client, "127.0.0.1", 0, limit=limit))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield srv.sockets[0].getsockname()[1]
+
+    async def shutdown():
+        srv.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def connect(port):
+    """建立客戶端並開啟同一張圖片，回傳 (client, mask)"""
+    clients = []
+
+    def _connect(image="img.tif", mask=None, keep_local=True):
+        mask = np.zeros(SHAPE, dtype=np.uint8) if mask is None else mask
+        client = MaskClient(port=port)
+        client.open_image(image, mask, keep_local)
+        clients.append(client)
+        return client, mask
+
+    yield _connect
+    for client in clients:
+        client.close()
+
+
+def settle(*pairs, until, timeout=2.0):
+    """持續 poll 直到條件成立"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for client, mask in pairs:
+            client.poll(mask)
+        if until():
+            return
+        time.sleep(0.01)
+    raise AssertionError("等待伺服器更新逾時")
+
+
+def synced(*pairs):
+    return all(client.tile_size is not None and not client.sent for client, _ in pairs)
+
+
+def test_concurrent_edits_in_one_tile_converge(connect):
+    a, b = connect(), connect()
+    settle(a, b, until=lambda: synced(a, b))
+
+    a[1][10:20, 10:20] = 255
+    b[1][30:40, 30:40] = 255
+    a[0].sync(a[1], [(slice(10, 20), slice(10, 20))])
+    b[0].sync(b[1], [(slice(30, 40), slice(30, 40))])
+    settle(a, b, until=lambda: synced(a, b) and (a[1] == b[1]).all()
+           and a[1][30:40, 30:40].all())
+
+    assert a[1][10:20, 10:20].all()
+    assert a[1].sum() == 200 * 255
+
+
+def test_erase_propagates(connect):
+    a, b = connect(), connect()
+    settle(a, b, until=lambda: synced(a, b))
+
+    a[1][0:50, 0:50] = 255
+    a[0].sync(a[1], FULL)
+    settle(a, b, until=lambda: b[1][0:50, 0:50].all())
+
+    b[1][0:10, 0:10] = 0
+    b[0].sync(b[1], [(slice(0, 10), slice(0, 10))])
+    settle(a, b, until=lambda: not a[1][0:10, 0:10].any())
+
+    assert (a[1] == b[1]).all()
+    assert a[1][10:50, 10:50].all()
+
+
+def test_late_joiner_receives_snapshot(connect):
+    a = connect()
+    settle(a, until=lambda: synced(a))
+    a[1][100:180, 100:140] = 255
+    a[0].sync(a[1], FULL)
+    settle(a, until=lambda: synced(a))
+
+    c = connect()
+    settle(c, until=lambda: c[0].tile_size is not None)
+    assert (c[1] == a[1]).all()
+
+
+def test_local_edits_before_snapshot_are_merged(connect):
+    a = connect()
+    settle(a, until=lambda: synced(a))
+    a[1][0:5, 0:5] = 255
+    a[0].sync(a[1], FULL)
+    settle(a, until=lambda: synced(a))
+
+    # 開啟前已有本機內容，snapshot 到達後兩者合併並送出
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[150:160, 0:10] = 255
+    b = connect(mask=mask)
+    settle(a, b, until=lambda: synced(b) and a[1][150:160, 0:10].all())
+
+    assert b[1][0:5, 0:5].all()
+    assert (a[1] == b[1]).all()
+
+
+def test_reconnect_without_local_content_uses_server_mask(connect):
+    a, b = connect(), connect()
+    settle(a, b, until=lambda: synced(a, b))
+    a[1][0:20, 0:20] = 255
+    a[0].sync(a[1], FULL)
+    settle(a, b, until=lambda: b[1][0:20, 0:20].all())
+
+    # a 斷線期間 b 擦除部分像素
+    stale = a[1].copy()
+    a[0].close()
+    b[1][0:10, 0:10] = 0
+    b[0].sync(b[1], FULL)
+    settle(b, until=lambda: synced(b))
+
+    c = connect(mask=stale, keep_local=False)
+    settle(c, b, until=lambda: synced(c))
+    assert not c[1][0:10, 0:10].any()
+    assert (c[1] == b[1]).all()
+
+
+def test_stale_tile_versions_are_ignored(connect):
+    a = connect()
+    settle(a, until=lambda: synced(a))
+    a[1][0:10, 0:10] = 255
+    a[0].sync(a[1], FULL)
+    settle(a, until=lambda: synced(a) and a[0].versions.get((0, 0)) == 1)
+
+    empty = mask_server.encode_tile(np.zeros((TILE_SIZE, TILE_SIZE), dtype=bool))
+    a[0].messages.put({"op": "tiles", "image": "img.tif",
+                       "tiles": [{"ty": 0, "tx": 0, "version": 1, "mask": empty}]})
+    assert not a[0].poll(a[1])
+    assert a[1][0:10, 0:10].all()
+
+
+def test_shape_mismatch_reports_error(connect):
+    a = connect()
+    settle(a, until=lambda: synced(a))
+
+    b = connect(mask=np.zeros((10, 10), dtype=np.uint8))
+    settle(b, until=lambda: b[0].error is not None)
+    assert b[0].tile_size is None
+    assert b[0].open_failed
+
+    # 開啟失敗後的編輯不再累積
+    b[1][0:5, 0:5] = 255
+    b[0].sync(b[1], FULL)
+    assert b[0].pending == []
+
+
+def test_rejected_edit_is_rolled_back(connect, monkeypatch):
+    a, b = connect(), connect()
+    settle(a, b, until=lambda: synced(a, b))
+
+    monkeypatch.setattr(mask_server, "encode_tile",
+                        lambda m: {"size": list(m.shape), "counts": [-1]})
+    a[1][0:10, 0:10] = 255
+    a[0].sync(a[1], FULL)
+    monkeypatch.undo()
+
+    settle(a, b, until=lambda: a[0].error is not None and not a[0].sent)
+    assert not a[1].any()
+    assert not b[1].any()
+
+
+def test_malformed_delta_keeps_connection(port):
+    with socket.create_connection(("127.0.0.1", port)) as sock, \
+            sock.makefile("r", encoding="utf-8") as f:
+        def request(msg):
+            sock.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+            return json.loads(f.readline())
+
+        assert request({"op": "open", "image": "raw", "shape": [64, 64]})["op"] == "snapshot"
+        bad = {"size": [64, 64], "counts": [-5, 4101]}
+        reply = request({"op": "edit", "image": "raw", "seq": 7,
+                         "tiles": [{"ty": 0, "tx": 0, "set": bad, "clear": bad}]})
+        assert reply["op"] == "error"
+        assert (reply["request"], reply["image"], reply["seq"]) == ("edit", "raw", 7)
+
+        ok = {"size": [64, 64], "counts": [4096]}
+        reply = request({"op": "edit", "image": "raw", "seq": 8,
+                         "tiles": [{"ty": 0, "tx": 0, "set": ok, "clear": ok}]})
+        assert reply["op"] == "tiles"
+
+
+def test_send_on_broken_connection_marks_disconnected(connect):
+    a = connect()
+    settle(a, until=lambda: synced(a))
+
+    # 連線已中斷時，poll 中的 snapshot 同步不應拋出例外
+    broken = socket.socket()
+    broken.close()
+    original, a[0].sock = a[0].sock, broken
+    a[1][0:10, 0:10] = 255
+    a[0].pending = FULL
+    a[0].tile_size = None
+    a[0].messages.put({"op": "snapshot", "image": "img.tif", "tile_size": TILE_SIZE, "tiles": []})
+    a[0].poll(a[1])
+    assert not a[0].connected
+    original.close()
+
+
+def test_large_edit_is_sent_in_batches(connect, monkeypatch):
+    monkeypatch.setattr(mask_server, "EDIT_BATCH_LIMIT", 500)
+    a, b = connect(), connect()
+    settle(a, b, until=lambda: synced(a, b))
+
+    a[1][:] = np.tile(np.array([0, 255], dtype=np.uint8), SHAPE[1] // 2)
+    seq = a[0].seq
+    a[0].sync(a[1], FULL)
+    assert a[0].seq - seq > 1
+
+    settle(a, b, until=lambda: synced(a) and (a[1] == b[1]).all())
+
+
+@pytest.mark.parametrize("port", [1024], indirect=True)
+def test_oversized_message_gets_error_reply(port):
+    with socket.create_connection(("127.0.0.1", port)) as sock, \
+            sock.makefile("r", encoding="utf-8") as f:
+        sock.sendall(b'{"op": "open", "image": "' + b"x" * 4096 + b'"}\n')
+        reply = json.loads(f.readline())
+        assert reply["op"] == "error"
+        assert f.readline() == ""